@@ -1,41 +1,124 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.responses import HTMLResponse
-from typing import Dict, List
-import json
+from typing import Dict, Optional, Set
+import asyncio
+import math
+import orjson
 
+# Run with `uvicorn tracking:app --loop uvloop` for the faster event loop
+# (uvicorn's default `--loop auto` already picks uvloop when it's installed)
 app = FastAPI(title="Live Vehicle Tracking")
 
+# Max connections enqueued per pass before yielding back to the event loop
+BROADCAST_BATCH_SIZE = 50
+# Pending frames per connection; older GPS frames are dropped past this
+SEND_QUEUE_SIZE = 64
+# GPS frames are tiny; anything larger isn't forwarded as-is
+MAX_FRAME_SIZE = 512
+# How long to wait for a newer frame before broadcasting, and the most
+# frames folded into one broadcast so a flood can't delay it forever
+COALESCE_WINDOW = 0.005
+COALESCE_MAX_FRAMES = 20
+
 # ---------------- CONNECTION MANAGER ----------------
 class ConnectionManager:
     def __init__(self):
-        # vehicle_id -> list of websockets
-        self.active_connections: Dict[int, List[WebSocket]] = {}
+        # vehicle_id -> set of websockets
+        self.active_connections: Dict[int, Set[WebSocket]] = {}
+        # websocket -> outgoing frame queue and the task draining it
+        self.send_queues: Dict[WebSocket, asyncio.Queue] = {}
+        self.send_tasks: Dict[WebSocket, asyncio.Task] = {}
 
     async def connect(self, websocket: WebSocket, vehicle_id: int):
         await websocket.accept()
-        if vehicle_id not in self.active_connections:
-            self.active_connections[vehicle_id] = []
-        self.active_connections[vehicle_id].append(websocket)
+        self.active_connections.setdefault(vehicle_id, set()).add(websocket)
+        self.send_queues[websocket] = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        self.send_tasks[websocket] = asyncio.create_task(self._sender(websocket, vehicle_id))
         print(f"New connection for Vehicle {vehicle_id}. Active: {len(self.active_connections[vehicle_id])}")
 
     def disconnect(self, websocket: WebSocket, vehicle_id: int):
-        if vehicle_id in self.active_connections:
-            if websocket in self.active_connections[vehicle_id]:
-                self.active_connections[vehicle_id].remove(websocket)
-            if not self.active_connections[vehicle_id]:
-                del self.active_connections[vehicle_id]
+        task = self._remove(websocket, vehicle_id)
+        if task is not None:
+            task.cancel()
         print(f"Vehicle {vehicle_id} disconnected.")
 
-    async def broadcast(self, vehicle_id: int, message: str):
-        if vehicle_id in self.active_connections:
-            for connection in self.active_connections[vehicle_id]:
-                try:
-                    await connection.send_text(message)
-                except Exception as e:
-                    print(f"Error broadcasting to a connection: {e}")
+    def _remove(self, websocket: WebSocket, vehicle_id: int) -> Optional[asyncio.Task]:
+        # Stop routing frames to this socket; returns its sender task (if still tracked)
+        conns = self.active_connections.get(vehicle_id)
+        if conns is not None:
+            conns.discard(websocket)
+            if not conns:
+                del self.active_connections[vehicle_id]
+        self.send_queues.pop(websocket, None)
+        return self.send_tasks.pop(websocket, None)
+
+    async def broadcast(self, vehicle_id: int, payload: bytes, exclude: Optional[WebSocket] = None):
+        # payload is serialized once by the caller and shared by every send.
+        # Frames are only queued here; each connection's sender task does the
+        # actual send, so a slow client can't stall the others.
+        conns = tuple(c for c in self.active_connections.get(vehicle_id, ()) if c is not exclude)
+        for i, connection in enumerate(conns, 1):
+            self._enqueue(connection, payload)
+            # Large audience: yield between batches so other requests on the
+            # loop aren't starved
+            if i % BROADCAST_BATCH_SIZE == 0:
+                await asyncio.sleep(0)
+
+    def _enqueue(self, websocket: WebSocket, payload: bytes):
+        queue = self.send_queues.get(websocket)
+        if queue is None:
+            return
+        try:
+            queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            # GPS frames are idempotent state, so drop the oldest one
+            queue.get_nowait()
+            queue.put_nowait(payload)
+
+    async def _sender(self, websocket: WebSocket, vehicle_id: int):
+        queue = self.send_queues[websocket]
+        while True:
+            payload = await queue.get()
+            try:
+                await websocket.send_bytes(payload)
+            except Exception as e:
+                print(f"Error broadcasting to a connection: {e}")
+                # Just stop routing frames here; the handler's own disconnect()
+                # does the rest once its receive fails
+                self._remove(websocket, vehicle_id)
+                return
+
+# ---------------- LOCATION CACHE ----------------
+class Location:
+    # One per vehicle, updated in place on every frame
+    __slots__ = ("lat", "lng")
+
+    def __init__(self, lat: float, lng: float):
+        self.lat = lat
+        self.lng = lng
+
+async def receive_frame(websocket: WebSocket) -> bytes:
+    # Bundled pages send binary frames; older or third-party clients may
+    # still send text, so accept both
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    data = message.get("bytes")
+    if data is None:
+        data = message["text"].encode()
+    return data
+
+def coerce_coord(value) -> float:
+    # Frames are forwarded verbatim, so only real JSON numbers get through
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise TypeError(f"coordinate must be a number, got {value!r}")
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError(f"coordinate must be finite, got {value!r}")
+    return value
 
 manager = ConnectionManager()
-vehicle_locations = {}
+vehicle_locations: Dict[int, Location] = {}
 
 # ---------------- HOME PAGE (MAP VIEW) ----------------
 @app.get("/", response_class=HTMLResponse)
@@ -63,6 +146,7 @@ def gps_sender():
         let ws;
         const statusDiv = document.getElementById('status');
         const coordsDiv = document.getElementById('coords');
+        const encoder = new TextEncoder();
 
         function connect() {
             ws = new WebSocket("ws://" + window.location.host + "/ws/location/" + vehicleId);
@@ -78,7 +162,8 @@ def gps_sender():
                     };
                     coordsDiv.innerText = `Lat: ${data.lat}, Lng: ${data.lng}`;
                     if(ws.readyState === WebSocket.OPEN) {
-                        ws.send(JSON.stringify(data));
+                        // Binary frame, so the server can forward it without re-encoding
+                        ws.send(encoder.encode(JSON.stringify(data)));
                     }
                 }, err => {
                     coordsDiv.innerText = "Error: " + err.message;
@@ -123,6 +208,7 @@ def map_view():
     <script>
         let map, marker;
         const infoDiv = document.getElementById('info');
+        const decoder = new TextDecoder();
 
         function initMap() {
             map = new google.maps.Map(document.getElementById("map"), {
@@ -141,9 +227,10 @@ def map_view():
 
         function connect() {
             const ws = new WebSocket("ws://" + window.location.host + "/ws/location/1");
+            ws.binaryType = "arraybuffer";
 
             ws.onmessage = (event) => {
-                const data = JSON.parse(event.data);
+                const data = JSON.parse(decoder.decode(event.data));
                 const pos = { lat: data.lat, lng: data.lng };
                 marker.setPosition(pos);
                 map.panTo(pos);
@@ -169,12 +256,34 @@ async def websocket_location(websocket: WebSocket, vehicle_id: int):
     try:
         while True:
             # Wait for data from the driver
-            data = await websocket.receive_text()
-            location = json.loads(data)
-            vehicle_locations[vehicle_id] = location
+            raw = await receive_frame(websocket)
+            # Only the newest position matters, so fold any frames arriving
+            # right behind this one into a single broadcast
+            for _ in range(COALESCE_MAX_FRAMES):
+                try:
+                    raw = await asyncio.wait_for(receive_frame(websocket), timeout=COALESCE_WINDOW)
+                except asyncio.TimeoutError:
+                    break
+            if len(raw) > MAX_FRAME_SIZE:
+                print(f"Dropping oversized frame ({len(raw)} bytes) for Vehicle {vehicle_id}")
+                continue
+            try:
+                location = orjson.loads(raw)
+                lat, lng = coerce_coord(location["lat"]), coerce_coord(location["lng"])
+            except (orjson.JSONDecodeError, KeyError, TypeError, ValueError):
+                # One bad frame shouldn't drop the driver's connection
+                print(f"Dropping malformed frame for Vehicle {vehicle_id}")
+                continue
+            cached = vehicle_locations.get(vehicle_id)
+            if cached is None:
+                vehicle_locations[vehicle_id] = Location(lat, lng)
+            else:
+                cached.lat = lat
+                cached.lng = lng
             
-            # Broadcast to ALL clients (including the sender and any maps)
-            await manager.broadcast(vehicle_id, json.dumps(location))
+            # Forward the driver's frame unchanged to every other client
+            # (no re-serialization; the sender already has it)
+            await manager.broadcast(vehicle_id, raw, exclude=websocket)
     except WebSocketDisconnect:
         manager.disconnect(websocket, vehicle_id)
     except Exception as e:
@@ -1,26 +1,50 @@
+import hashlib
 import secrets
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from datetime import datetime, timedelta
-from typing import List
+from typing import FrozenSet, List
 
+import anyio.to_thread
 import googlemaps
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, Request, Response, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import create_engine, Column, Integer, String, Float, ForeignKey, DateTime
+from sqlalchemy import create_engine, func, select, true, Column, Integer, String, Float, ForeignKey, DateTime
 from sqlalchemy.orm import declarative_base, sessionmaker, Session, relationship
-from pydantic import BaseModel
-from jose import JWTError, jwt
+from pydantic import BaseModel, Field
+import jwt
+from jwt import InvalidTokenError as JWTError
 from passlib.context import CryptContext
 
 # -------------------- DATABASE CONFIG -----------------
 DATABASE_URL = "mysql+pymysql://root:@127.0.0.1/vehicle_project"
-
-engine = create_engine(DATABASE_URL, pool_pre_ping=True)
-SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
+DB_POOL_SIZE = 20
+DB_MAX_OVERFLOW = 40
+
+engine = create_engine(
+    DATABASE_URL,
+    pool_pre_ping=True,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_recycle=3600,
+    future=True
+)
+# expire_on_commit=False so returned rows don't re-query the DB while the response is serialized
+SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
 # -------------------- FASTAPI APP --------------------
-app = FastAPI(title="Vehicle Management System")
+# Sync routes (bcrypt) each hold a DB connection, so match the pool
+THREADPOOL_SIZE = DB_POOL_SIZE + DB_MAX_OVERFLOW
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    yield
+
+app = FastAPI(title="Vehicle Management System", lifespan=lifespan)
 
 @app.get("/")
 def root():
@@ -47,23 +71,36 @@ except (ValueError, Exception) as e:
     print(f"WARNING: Google Maps API initialization failed ({e}). Distance calculation will use a fallback value.")
     gmaps = None
 
+@lru_cache(maxsize=4096)
+def _cached_distance_km(pickup: str, drop: str):
+    # Pickup/drop pairs repeat a lot (depots, airports), so remember each lookup.
+    # Errors propagate and are not cached.
+    result = gmaps.distance_matrix(
+        origins=pickup,
+        destinations=drop,
+        mode="driving"
+    )
+    meters = result["rows"][0]["elements"][0]["distance"]["value"]
+    return meters / 1000
+
+def route_key(pickup: str, drop: str):
+    # Normalized (pickup, drop) pair that distance lookups are cached under
+    return pickup.strip().lower(), drop.strip().lower()
+
 def calculate_distance_km(pickup: str, drop: str):
     if gmaps is None or GOOGLE_MAPS_API_KEY == "YOUR_GOOGLE_MAPS_API_KEY":
         # Return a dummy distance for development/testing if API key is invalid
         return 15.0
     
     try:
-        result = gmaps.distance_matrix(
-            origins=pickup,
-            destinations=drop,
-            mode="driving"
-        )
-        meters = result["rows"][0]["elements"][0]["distance"]["value"]
-        return meters / 1000
+        return _cached_distance_km(*route_key(pickup, drop))
     except Exception as e:
         print(f"Error calculating distance: {e}")
         return 15.0
 
+# Shared by bulk trip ingestion for its network-bound distance lookups
+distance_pool = ThreadPoolExecutor(max_workers=8)
+
 # -------------------- LOCATION PRICING --------------------
 LOCATION_MULTIPLIER = {
     "chennai": 1.0,
@@ -72,14 +109,21 @@ LOCATION_MULTIPLIER = {
     "remote": 1.5
 }
 
+# Keys are already lowercase; bind the lookup once
+_location_multiplier_get = LOCATION_MULTIPLIER.get
+
 def get_location_multiplier(location: str):
-    return LOCATION_MULTIPLIER.get(location.lower(), 1.0)
+    # Skip the lower() copy when the input is already lowercase
+    return _location_multiplier_get(location if location.islower() else location.lower(), 1.0)
+
+def calculate_trip_amount(distance: float, rate_per_km: float, pickup: str):
+    return distance * rate_per_km * get_location_multiplier(pickup)
 
 # -------------------- MODELS --------------------
 class User(Base):
     __tablename__ = "users"
     id = Column(Integer, primary_key=True)
-    username = Column(String(50), unique=True, nullable=False)
+    username = Column(String(50), unique=True, index=True, nullable=False)
     password = Column(String(200), nullable=False)
     role = Column(String(20), nullable=False)
 
@@ -89,7 +133,7 @@ class Driver(Base):
     name = Column(String(100))
     phone = Column(String(15))
     salary_per_km = Column(Float)
-    location = Column(String(100))
+    location = Column(String(100), index=True)
 
 class Vehicle(Base):
     __tablename__ = "vehicles"
@@ -97,7 +141,7 @@ class Vehicle(Base):
     vehicle_number = Column(String(20), unique=True)
     type = Column(String(50))
     rate_per_km = Column(Float)
-    location = Column(String(100))
+    location = Column(String(100), index=True)
 
 class Trip(Base):
     __tablename__ = "trips"
@@ -131,6 +175,25 @@ def get_db():
     finally:
         db.close()
 
+# -------------------- ETAG --------------------
+def table_etag(db: Session, model):
+    # Rows are only ever inserted, so the row count and highest id
+    # change whenever the table does
+    count, max_id = db.query(func.count(model.id), func.max(model.id)).one()
+    return '"%s"' % hashlib.blake2b(f"{count}:{max_id}".encode(), digest_size=8).hexdigest()
+
+def etag_matches(request: Request, etag: str):
+    # If-None-Match uses weak comparison: it may be "*" or a comma-separated
+    # list, and proxies that compress responses add a W/ prefix
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
+
 # -------------------- SCHEMAS --------------------
 class Token(BaseModel):
     access_token: str
@@ -149,6 +212,9 @@ class DriverSchema(BaseModel):
     class Config:
         orm_mode = True
 
+class DriverResponse(DriverSchema):
+    id: int
+
 class VehicleSchema(BaseModel):
     vehicle_number: str
     type: str
@@ -157,12 +223,20 @@ class VehicleSchema(BaseModel):
     class Config:
         orm_mode = True
 
+class VehicleResponse(VehicleSchema):
+    id: int
+
 class TripCreate(BaseModel):
     driver_id: int
     vehicle_id: int
     pickup_location: str
     drop_location: str
 
+MAX_BULK_TRIPS = 500
+
+class TripsBulk(BaseModel):
+    trips: List[TripCreate] = Field(..., max_length=MAX_BULK_TRIPS)
+
 class TripResponse(BaseModel):
     id: int
     driver_id: int
@@ -192,13 +266,17 @@ def get_current_user(token: str = Depends(oauth2_scheme)):
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
-def require_role(roles: List[str]):
+def require_role(roles: FrozenSet[str]):
     def checker(user=Depends(get_current_user)):
         if user["role"] not in roles:
             raise HTTPException(status_code=403, detail="Access denied")
         return user
     return checker
 
+# Built once and shared, so every route reuses the same dependency callable
+admin_or_manager = require_role(frozenset({"admin", "manager"}))
+any_role = require_role(frozenset({"admin", "manager", "viewer"}))
+
 # -------------------- AUTH ROUTES --------------------
 @app.post("/register")
 def register(data: RegisterSchema, db: Session = Depends(get_db)):
@@ -220,43 +298,56 @@ def login(form: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get
     return {"access_token": token, "token_type": "bearer"}
 
 # -------------------- DRIVER APIs --------------------
-@app.post("/drivers", dependencies=[Depends(require_role(["admin", "manager"]))])
+@app.post("/drivers", response_model=DriverResponse, dependencies=[Depends(admin_or_manager)])
 def create_driver(data: DriverSchema, db: Session = Depends(get_db)):
     d = Driver(**data.dict())
     db.add(d)
     db.commit()
     return d
 
-@app.get("/drivers", dependencies=[Depends(require_role(["admin", "manager", "viewer"]))])
-def get_drivers(db: Session = Depends(get_db)):
+@app.get("/drivers", response_model=List[DriverResponse], dependencies=[Depends(any_role)])
+def get_drivers(request: Request, response: Response, db: Session = Depends(get_db)):
+    etag = table_etag(db, Driver)
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
     return db.query(Driver).all()
 
 # -------------------- VEHICLE APIs --------------------
-@app.post("/vehicles", dependencies=[Depends(require_role(["admin", "manager"]))])
+@app.post("/vehicles", response_model=VehicleResponse, dependencies=[Depends(admin_or_manager)])
 def create_vehicle(data: VehicleSchema, db: Session = Depends(get_db)):
     v = Vehicle(**data.dict())
     db.add(v)
     db.commit()
     return v
 
-@app.get("/vehicles", dependencies=[Depends(require_role(["admin", "manager", "viewer"]))])
-def get_vehicles(db: Session = Depends(get_db)):
+@app.get("/vehicles", response_model=List[VehicleResponse], dependencies=[Depends(any_role)])
+def get_vehicles(request: Request, response: Response, db: Session = Depends(get_db)):
+    etag = table_etag(db, Vehicle)
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
     return db.query(Vehicle).all()
 
 # -------------------- TRIP APIs --------------------
 @app.post("/trips", response_model=TripResponse,
-          dependencies=[Depends(require_role(["admin", "manager"]))])
+          dependencies=[Depends(admin_or_manager)])
 def create_trip(data: TripCreate, db: Session = Depends(get_db)):
 
-    driver = db.query(Driver).get(data.driver_id)
-    vehicle = db.query(Vehicle).get(data.vehicle_id)
+    # Fetch both in one round trip; no row means either one is missing.
+    # The 1x1 cross join is intentional, so spell it out as JOIN ... ON true.
+    row = db.execute(
+        select(Driver, Vehicle)
+        .join(Vehicle, true())
+        .where(Driver.id == data.driver_id, Vehicle.id == data.vehicle_id)
+    ).first()
 
-    if not driver or not vehicle:
+    if row is None:
         raise HTTPException(status_code=404, detail="Driver or Vehicle not found")
+    driver, vehicle = row
 
     distance = calculate_distance_km(data.pickup_location, data.drop_location)
-    multiplier = get_location_multiplier(data.pickup_location)
-    total_amount = distance * vehicle.rate_per_km * multiplier
+    total_amount = calculate_trip_amount(distance, vehicle.rate_per_km, data.pickup_location)
 
     trip = Trip(
         driver_id=data.driver_id,
@@ -272,7 +363,48 @@ def create_trip(data: TripCreate, db: Session = Depends(get_db)):
     db.refresh(trip)
     return trip
 
-@app.get("/trips", dependencies=[Depends(require_role(["admin", "manager", "viewer"]))])
-def get_trips(db: Session = Depends(get_db)):
+@app.post("/trips/bulk", dependencies=[Depends(admin_or_manager)])
+def create_trips_bulk(data: TripsBulk, db: Session = Depends(get_db)):
+    if not data.trips:
+        return {"created": 0}
+
+    driver_ids = {t.driver_id for t in data.trips}
+    vehicle_ids = {t.vehicle_id for t in data.trips}
+    found_drivers = {i for (i,) in db.query(Driver.id).filter(Driver.id.in_(driver_ids))}
+    vehicle_rates = dict(db.query(Vehicle.id, Vehicle.rate_per_km).filter(Vehicle.id.in_(vehicle_ids)))
+
+    if found_drivers != driver_ids or vehicle_rates.keys() != vehicle_ids:
+        raise HTTPException(status_code=404, detail="Driver or Vehicle not found")
+
+    # Distance lookups are network-bound, so run them side by side, once per
+    # distinct route (repeats within a batch would all miss the cache together)
+    keys = [route_key(t.pickup_location, t.drop_location) for t in data.trips]
+    routes = list(dict.fromkeys(keys))
+    route_distances = dict(zip(routes, distance_pool.map(lambda r: calculate_distance_km(*r), routes)))
+    distances = [route_distances[k] for k in keys]
+
+    rows = [
+        {
+            "driver_id": t.driver_id,
+            "vehicle_id": t.vehicle_id,
+            "pickup_location": t.pickup_location,
+            "drop_location": t.drop_location,
+            "distance": distance,
+            "total_amount": calculate_trip_amount(distance, vehicle_rates[t.vehicle_id], t.pickup_location)
+        }
+        for t, distance in zip(data.trips, distances)
+    ]
+
+    # One multi-row INSERT and a single commit for the whole batch
+    db.bulk_insert_mappings(Trip, rows)
+    db.commit()
+    return {"created": len(rows)}
+
+@app.get("/trips", response_model=List[TripResponse], dependencies=[Depends(any_role)])
+def get_trips(request: Request, response: Response, db: Session = Depends(get_db)):
+    etag = table_etag(db, Trip)
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
     return db.query(Trip).all()
 